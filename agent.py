@@ -148,6 +148,42 @@ class DQNAgent():
         return legal_actions[action_idx]
     
     
+    def step_batch(self, states, legal_masks=None):
+        ''' Predict actions for a batch of parallel environments.
+        One forward pass serves every environment, so the per-call PyTorch
+        overhead is amortized over the whole batch, and the legality filter
+        runs as one boolean-mask operation over the (batch, num_actions)
+        Q-matrix instead of per-environment index lists.
+
+        Parameters
+        ----------
+        states (list of dict): [{ 'obs': __, 'legal_actions': __ }, ...]
+        legal_masks (np.array of bool): (batch, num_actions) legality mask;
+        built from the states' legal_actions lists when not given
+
+        Returns
+        -------
+        actions (list of int): one action id per state
+
+        '''
+        obs_batch = np.stack([state['obs'] for state in states])
+        if legal_masks is None:
+            legal_masks = np.zeros((len(states), self.num_actions), dtype=bool)
+            for b, state in enumerate(states):
+                legal_masks[b, state['legal_actions']] = True
+        q_batch = self.eval_model.predict_nograd(obs_batch)
+        masked_q_values = np.where(legal_masks, q_batch, -np.inf)
+        actions = masked_q_values.argmax(axis=1)
+        # epsilon-greedy: picking uniformly among legal actions with
+        # probability epsilon gives every legal action epsilon/n mass and the
+        # best one (1-epsilon) extra, same distribution as the single step()
+        epsilon = self.epsilons[min(self.total_t, self.epsilon_decay_steps-1)]
+        explore = np.random.random(len(states)) < epsilon
+        for b in np.flatnonzero(explore):
+            actions[b] = np.random.choice(np.flatnonzero(legal_masks[b]))
+        return actions.tolist()
+
+
     def eval_step(self, state):
         
         ''' Predict the action for evaluation purpose.
@@ -273,6 +309,11 @@ class Model():
             if len(p.data.shape) > 1:
                 nn.init.xavier_uniform_(p.data)
 
+        # persistent pinned staging buffers for async host->device copies,
+        # one per batch shape: the rollout batch and the training batch
+        # alternate every tick, and page-lock allocation is expensive
+        self.pinned = {}
+
         # set up loss function
         self.MSE_loss = nn.MSELoss(reduction='mean')
 
@@ -292,7 +333,17 @@ class Model():
           action values.
         '''
         with torch.no_grad():
-            s = torch.from_numpy(s).float().to(self.device)
+            if self.device is not None and torch.device(self.device).type == 'cuda':
+                # stage through pinned memory so the host->device copy is
+                # async (non_blocking only overlaps from pinned buffers)
+                pinned = self.pinned.get(s.shape)
+                if pinned is None:
+                    pinned = torch.empty(s.shape, dtype=torch.float32, pin_memory=True)
+                    self.pinned[s.shape] = pinned
+                np.copyto(pinned.numpy(), s)
+                s = pinned.to(self.device, non_blocking=True)
+            else:
+                s = torch.from_numpy(s).float().to(self.device)
             q_as = self.qnet(s).cpu().numpy()
         return q_as
     
@@ -7,20 +7,103 @@ Created on Thu Feb 17 16:05:46 2022
 """
 import numpy as np
 import pygame # render the game state
-import time # control AI step internal 
+import time # control AI step internal
 import random
+import logging
+import os
 import torch
 import torch.nn as nn
 
 from agent import DQNAgent
 
+try:
+    from numba import njit
+except ImportError: # numba is optional, fall back to plain Python
+    def njit(func=None, **kwargs):
+        if func is None:
+            return lambda f: f
+        return func
+
+try:
+    # optional C accelerator, built with `python setup.py build_ext --inplace`
+    import game_core
+except ImportError:
+    game_core = None
+
+
+
+@njit(cache=True)
+def legal_actions_nb(bits, row, col, full, col_ge2, col_le2):
+    '''
+    Scan the bitboard for all legal std_actions.
+    Free function on plain ints so numba can compile the training hot loop.
+
+    Returns
+    -------
+    std_actions (np.array of int64), in cell-major order
+
+    '''
+    empty = ~bits & full
+    up    = bits & (bits << col) & (empty << (2*col))
+    down  = bits & (bits >> col) & (empty >> (2*col))
+    left  = bits & (bits << 1) & (empty << 2) & col_ge2
+    right = bits & (bits >> 1) & (empty >> 2) & col_le2
+    out = np.empty(row*col*4, np.int64)
+    n = 0
+    for idx in range(row*col):
+        b = 1 << idx
+        if up & b:
+            out[n] = idx*4 + 0
+            n += 1
+        if down & b:
+            out[n] = idx*4 + 1
+            n += 1
+        if left & b:
+            out[n] = idx*4 + 2
+            n += 1
+        if right & b:
+            out[n] = idx*4 + 3
+            n += 1
+    return out[:n]
+
+
+@njit(cache=True)
+def is_end_nb(bits, row, col, full, col_ge2, col_le2):
+    '''
+    Judge whether any legal move remains, without extracting the action list.
+
+    Returns
+    -------
+    flag (bool)
+
+    '''
+    empty = ~bits & full
+    up    = bits & (bits << col) & (empty << (2*col))
+    down  = bits & (bits >> col) & (empty >> (2*col))
+    left  = bits & (bits << 1) & (empty << 2) & col_ge2
+    right = bits & (bits >> 1) & (empty >> 2) & col_le2
+    return (up | down | left | right) == 0
+
 
 class Game():
-    ''' 
+    '''
     Create a game enviroment for Ferrero game.
     Game area is a 6 plus 8 np.array.
-    
+
     '''
+    # Board memos, shared by every instance: the parallel training envs all
+    # play the same 6x8 game, so a board one env has scanned (or proven
+    # terminal) is a hit for the other envs too, and the memory bound is
+    # paid once instead of per env.
+    # legal_cache: bitboard -> legal std_actions, so the repeated queries
+    # of one tick (is_end, update, step) only scan the board once.
+    # terminal_cache: bitboard -> (True, reward) for proven terminal
+    # positions, a dict hit replaces the whole end-of-game derivation
+    legal_cache = {}
+    LEGAL_CACHE_SIZE = 100000
+    terminal_cache = {}
+    TERMINAL_CACHE_SIZE = 1000000
+
     def __init__(self,
                  ROW=6,
                  COL=8,
@@ -52,14 +135,49 @@ class Game():
         self.actions_num = actions_num
         self.episodes = episodes
         self.state = {'obs': None, 'legal_actions':None}
+        # Bitboard representation: bit i*COL+j is cell (i, j).
+        # self.state['obs'] is kept in sync as a plain array view for
+        # render() and the agent network.
+        self.bits = 0
+        self.FULL = (1 << (ROW * COL)) - 1
+        # Border masks for horizontal moves (vertical moves cannot wrap
+        # between rows, the shifts already handle the board edges)
+        self.COL_GE2 = sum(1 << (i*COL + j) for i in range(ROW) for j in range(COL) if j >= 2)
+        self.COL_LE2 = sum(1 << (i*COL + j) for i in range(ROW) for j in range(COL) if j <= COL - 3)
+        # Lookup table std_action -> (x, y, direc), built once so the
+        # per-step divmods and dict construction disappear from the hot path
+        self.STD2XYD = np.empty((actions_num, 3), np.int8)
+        for a in range(actions_num):
+            self.STD2XYD[a] = ((a // 4) // COL, (a // 4) % COL, a % 4)
+        # Per-action bitboard XOR masks and (src, mid, dst) flat cell indices,
+        # so step() applies any move without branching on the direction.
+        # Kept as a plain int list: XOR with a Python int bitboard is cheaper
+        # than going through a NumPy scalar.
+        # Entries for off-board actions stay zero; they are never legal
+        self.APPLY_XOR = [0] * actions_num
+        self.SRC_MID_DST = np.zeros((actions_num, 3), np.int8)
+        # Destination cell (x, y) of every std_action, for get_legal_pos
+        self.DEST_XY = np.zeros((actions_num, 2), np.int8)
+        offsets = (-COL, COL, -1, 1) # up, down, left, right
+        for a in range(actions_num):
+            src, direc = a >> 2, a & 3
+            mid, dst = src + offsets[direc], src + 2*offsets[direc]
+            if 0 <= mid < ROW*COL and 0 <= dst < ROW*COL:
+                self.APPLY_XOR[a] = (1 << src) | (1 << mid) | (1 << dst)
+                self.SRC_MID_DST[a] = (src, mid, dst)
+                self.DEST_XY[a] = (dst // COL, dst % COL)
         
     def reset(self):
         ''' 
         Reset game state.
         '''
         ROW, COL = self.ROW, self.COL
-        self.state['obs'] = np.ones((ROW, COL))
+        self.bits = self.FULL & ~1 # all cells occupied except (0, 0)
+        # uint8 is enough for 0/1 occupancy: 8x smaller than float64 in the
+        # replay buffer, cast to float32 once at the torch boundary
+        self.state['obs'] = np.ones((ROW, COL), dtype=np.uint8)
         self.state['obs'][0, 0] = 0
+        self.num_pegs = ROW*COL - 1 # every move removes exactly one peg
         self.state['legal_actions'] = self.get_legal_actions()
     
         
@@ -72,39 +190,65 @@ class Game():
         flag (bool)
 
         '''
-        actions = self.get_legal_actions()
-        return True if actions == [] else False
-    
-    
+        actions = self.state['legal_actions']
+        if actions is None: # only before the first reset()
+            if game_core is not None:
+                return game_core.is_end(self.bits, self.ROW, self.COL, self.FULL,
+                                        self.COL_GE2, self.COL_LE2)
+            return is_end_nb(self.bits, self.ROW, self.COL, self.FULL,
+                             self.COL_GE2, self.COL_LE2)
+        return actions == []
+
+
     def get_legal_actions(self):
         '''
-        Return all legal std_actions.
+        Return all legal std_actions, memoized on the bitboard.
 
         Returns
         -------
         std_actions (list of int)
 
         '''
-        ROW, COL = self.ROW, self.COL
-        std_actions = []
-        for i in range(ROW):
-            for j in range(COL):
-                if self.state['obs'][i, j] == 1:
-                    if 0 <= i - 2 < ROW:
-                        if self.state['obs'][i-1, j] == 1 and self.state['obs'][i-2, j] == 0: # up
-                            std_actions.append( (i*COL+j)*4 + 0 )
-                    if 0 <= i + 2 < ROW:
-                        if self.state['obs'][i+1, j] == 1 and self.state['obs'][i+2, j] == 0: # down
-                            std_actions.append( (i*COL+j)*4 + 1 )
-                    if 0 <= j - 2 < COL:
-                        if self.state['obs'][i, j-1] == 1 and self.state['obs'][i, j-2] == 0: # left
-                            std_actions.append( (i*COL+j)*4 + 2 )
-                    if 0 <= j + 2 < COL:
-                        if self.state['obs'][i, j+1] == 1 and self.state['obs'][i, j+2] == 0: # right 
-                            std_actions.append( (i*COL+j)*4 + 3 )
+        std_actions = self.legal_cache.get(self.bits)
+        if std_actions is None:
+            std_actions = self.compute_legal_actions()
+            if len(self.legal_cache) >= self.LEGAL_CACHE_SIZE: # FIFO eviction
+                self.legal_cache.pop(next(iter(self.legal_cache)))
+            self.legal_cache[self.bits] = std_actions
         return std_actions
+
+
+    def compute_legal_actions(self):
+        '''
+        Scan the bitboard for all legal std_actions.
+
+        Returns
+        -------
+        std_actions (list of int)
+
+        '''
+        if game_core is not None:
+            return game_core.legal_actions(self.bits, self.ROW, self.COL, self.FULL,
+                                           self.COL_GE2, self.COL_LE2)
+        return legal_actions_nb(self.bits, self.ROW, self.COL, self.FULL,
+                                self.COL_GE2, self.COL_LE2).tolist()
     
     
+    def get_legal_mask(self):
+        '''
+        Return the legal actions as a boolean mask over all std_actions,
+        ready for vectorized Q-value masking in the agent.
+
+        Returns
+        -------
+        mask (np.array of bool), shape (actions_num,)
+
+        '''
+        mask = np.zeros(self.actions_num, dtype=bool)
+        mask[self.get_legal_actions()] = True
+        return mask
+
+
     def get_legal_pos(self, pos):
         '''
         Return all legal positions given a selected position
@@ -118,23 +262,13 @@ class Game():
         legal_pos (list of tuple): [(x1, y1), (x2, y2),...] 
 
         '''
-        ROW, COL = self.ROW, self.COL
         (x, y) = pos
-        legal_pos = []
-        if self.state['obs'][x, y] == 1:
-            if 0 <= x - 2 < ROW:
-                if self.state['obs'][x-1, y] == 1 and self.state['obs'][x-2, y] == 0: # up
-                    legal_pos.append((x-2, y))
-            if 0 <= x + 2 < ROW:
-                if self.state['obs'][x+1, y] == 1 and self.state['obs'][x+2, y] == 0: # down
-                    legal_pos.append((x+2, y))
-            if 0 <= y - 2 < COL:
-                if self.state['obs'][x, y-1] == 1 and self.state['obs'][x, y-2] == 0: # left
-                    legal_pos.append((x, y-2))
-            if 0 <= y + 2 < COL:
-                if self.state['obs'][x, y+1] == 1 and self.state['obs'][x, y+2] == 0: # left
-                    legal_pos.append((x, y+2))
-        return legal_pos
+        # The legal actions of the whole board are already memoized, so the
+        # per-cell test is just a filter on the source cell plus a
+        # destination lookup
+        pos_idx = x*self.COL + y
+        return [(int(self.DEST_XY[a, 0]), int(self.DEST_XY[a, 1]))
+                for a in self.get_legal_actions() if a >> 2 == pos_idx]
                    
     
     def raw_to_std(self, raw_action):
@@ -168,11 +302,8 @@ class Game():
         raw_action (dict): {'pos': pos (tuple), 'direc': direc (int)}
 
         '''
-        COL = self.COL
-        direc = std_action % 4
-        tmp = std_action // 4
-        x, y = tmp // COL, tmp % COL
-        return {'pos':(x, y), 'direc':direc}
+        x, y, direc = self.STD2XYD[std_action]
+        return {'pos':(int(x), int(y)), 'direc':int(direc)}
         
         
     def step(self, std_action):
@@ -192,33 +323,39 @@ class Game():
         done (bool)
 
         '''
-        state = self.state
-        raw_action = self.std_to_raw(std_action)
-        (x, y), direc = raw_action['pos'], raw_action['direc']
-        self.state['obs'][x, y] = 0
-        if direc == 0: # up
-            self.state['obs'][x-1, y] = 0
-            self.state['obs'][x-2, y] = 1
-        elif direc == 1: # down
-            self.state['obs'][x+1, y] = 0
-            self.state['obs'][x+2, y] = 1
-        elif direc == 2: # left
-            self.state['obs'][x, y-1] = 0
-            self.state['obs'][x, y-2] = 1
-        elif direc == 3: # right
-            self.state['obs'][x, y+1] = 0
-            self.state['obs'][x, y+2] = 1
-        
-        next_state = self.state
-        next_state['legal_actions'] = self.get_legal_actions()
+        # Snapshot the pre-move state: self.state['obs'] is mutated in place
+        # below, so handing out self.state itself would feed the replay
+        # buffer transitions where state and next_state are the same object
+        state = {'obs': self.state['obs'].copy(),
+                 'legal_actions': self.state['legal_actions']}
+        src, mid, dst = self.SRC_MID_DST[std_action]
+        obs = self.state['obs']
+        obs.flat[src] = 0
+        obs.flat[mid] = 0
+        obs.flat[dst] = 1
+        # src and mid flip 1 -> 0, dst flips 0 -> 1
+        self.bits ^= self.APPLY_XOR[std_action]
+        self.num_pegs -= 1
+
+        legal_actions = self.get_legal_actions()
+        self.state['legal_actions'] = legal_actions # keep the live state fresh
+        next_state = {'obs': self.state['obs'].copy(),
+                      'legal_actions': legal_actions}
         
         reward = 0
         done = False
-        if self.is_end():
-            reward = 8 - self.state['obs'].sum()
+        cached = self.terminal_cache.get(self.bits)
+        if cached is not None:
+            done, reward = cached
+        elif legal_actions == []: # no extra is_end scan, the list is in hand
+            reward = 8 - self.num_pegs # counter kept in step, no board pass
             done = True
+            if len(self.terminal_cache) >= self.TERMINAL_CACHE_SIZE: # FIFO eviction
+                self.terminal_cache.pop(next(iter(self.terminal_cache)))
+            self.terminal_cache[self.bits] = (True, reward)
+        if done:
             self.reset()
-        
+
         return state, next_state, reward, done
         
                 
@@ -236,9 +373,15 @@ class UserInterface():
     def __init__(self):
         pygame.init()
         
-        # Create Game object
-        self.game = Game()
-        self.game.reset()
+        # Create Game objects
+        # AI training steps NUM_ENVS games in parallel so the network runs
+        # one batched forward pass per tick instead of NUM_ENVS tiny ones.
+        # games[0] is the one rendered on screen and played by a human
+        self.NUM_ENVS = 64
+        self.games = [Game() for _ in range(self.NUM_ENVS)]
+        for game in self.games:
+            game.reset()
+        self.game = self.games[0]
         self.ROW, self.COL = self.game.ROW, self.game.COL
         
         # Create Agent object
@@ -256,22 +399,43 @@ class UserInterface():
         self.running = True # UI running flag
         self.clock = pygame.time.Clock() # FPS control
         self.time = time.time() # record time
+        self.dirty = True # whether the screen needs a redraw
         
         # Switch mode
         # AI will move only if human_mode == False and AI_mode == True
         self.human_mode = False # whether allow human action
         self.AI_mode = True # whether allow AI action
+        self.debug = False # log mouse input; print stalls the frame loop
         
         # Store human input
         # if select['action'] is not none, it will be executed in update()
         self.select = {'pos':None, 'legal_pos':[], 'action':None}
         
         # Load image
-        self.img = pygame.image.load('texture/ferrero1.png').convert_alpha()
-        self.img = pygame.transform.smoothscale(self.img, (self.SIZE, self.SIZE))
-        self.img_legal = pygame.image.load('texture/legal.png').convert_alpha()
-        self.img_legal = pygame.transform.smoothscale(self.img_legal, (0.7*self.SIZE, 0.7*self.SIZE))
+        # Pre-scaled copies are cached on disk, so smoothscale only runs on
+        # the first launch; convert_alpha matches the display pixel format
+        self.img = self.load_scaled('ferrero1', self.SIZE)
+        self.img_legal = self.load_scaled('legal', int(0.7*self.SIZE))
         
+        # Precompute the pixel origin of every cell (and of the legal-move
+        # hint, which is inset by 0.2 cell), so render() batches all tile
+        # blits through one window.blits call instead of a Python loop
+        self.cell_px = np.array([[(j*self.SIZE, i*self.SIZE) for j in range(self.COL)]
+                                 for i in range(self.ROW)], dtype=np.int32)
+        self.hint_px = self.cell_px + int(0.2*self.SIZE)
+
+        # Static background (fill + grid lines), rendered once; render()
+        # restores regions of it instead of repainting the whole window
+        LINECOLOR = (72,61,139)
+        self.bg = pygame.Surface(self.window.get_size())
+        self.bg.fill(self.BGCOLOR)
+        for i in range(self.ROW + 1):
+            pygame.draw.line(self.bg, LINECOLOR, (0, i*self.SIZE), (self.COL*self.SIZE, i*self.SIZE), 4)
+        for i in range(self.COL + 1):
+            pygame.draw.line(self.bg, LINECOLOR, (i*self.SIZE, 0), (i*self.SIZE, self.ROW*self.SIZE), 4)
+        self.prev_obs = None # board as of the last redraw
+        self.overlay_shown = False # selection overlay was drawn last frame
+
         # Load font
         self.font = pygame.font.Font('texture/BD_Cartoon_Shout.ttf', 20)
         
@@ -279,6 +443,31 @@ class UserInterface():
         self.select_text = self.font.render('select', True, (220,20,60))
      
         
+    def load_scaled(self, name, size):
+        '''
+        Load texture/<name>.png scaled to size x size.
+        The scaled surface is saved back to texture/ on first use and loaded
+        directly afterwards, skipping the smoothscale filter.
+
+        Parameters
+        ----------
+        name (str) : texture file name without extension
+        size (int) : target width and height in pixels
+
+        Returns
+        -------
+        img (pygame.Surface)
+
+        '''
+        cached = 'texture/%s_%d.png' % (name, size)
+        if os.path.exists(cached):
+            return pygame.image.load(cached).convert_alpha()
+        img = pygame.image.load('texture/%s.png' % name).convert_alpha()
+        img = pygame.transform.smoothscale(img, (size, size))
+        pygame.image.save(img, cached)
+        return img
+
+
     def processInput(self):
         for event in pygame.event.get():
             # Press cancel button on the top right corner to quit the game
@@ -286,9 +475,11 @@ class UserInterface():
                 self.running = False
                 break
             elif event.type == pygame.MOUSEBUTTONDOWN and self.human_mode: # Press mouse
-                x, y = pygame.mouse.get_pos()            
-                if event.button == 1: # Press left mouse button to select 
-                    print('left click: (%d,%d)' % (x, y))
+                self.dirty = True
+                x, y = pygame.mouse.get_pos()
+                if event.button == 1: # Press left mouse button to select
+                    if self.debug:
+                        logging.debug('left click: (%d,%d)', x, y)
                     row = y // self.SIZE
                     col = x // self.SIZE
                     
@@ -309,7 +500,8 @@ class UserInterface():
                         if self.game.state['obs'][row, col] == 1:
                             self.select['pos'] = (row, col)
                             self.select['legal_pos'] = self.game.get_legal_pos((row, col))
-                            print('legal position: ', self.select['legal_pos'])
+                            if self.debug:
+                                logging.debug('legal position: %s', self.select['legal_pos'])
                     
     
     def update(self):
@@ -321,59 +513,79 @@ class UserInterface():
                 a = self.game.raw_to_std(self.select['action'])
                 self.game.step(a)
                 self.select = {'pos':None, 'legal_pos':[], 'action':None}
+                self.dirty = True
             
         if self.AI_mode == True and self.human_mode == False:
             if self.game.episodes > 0:
-                if self.game.is_end() is not True:
-                    # state (dict) : {'obs':obs, 'legal_actions':legal_actions} 
-                    self.game.state['legal_actions'] = self.game.get_legal_actions()
-                    action = self.agent.step(self.game.state)
-                    state, next_state, reward, done = self.game.step(action)
+                # state (dict) : {'obs':obs, 'legal_actions':legal_actions}
+                # legal_actions is always fresh and non-empty: reset() and
+                # step() keep it up to date, and step() resets finished games
+                states = [game.state for game in self.games]
+                legal_masks = np.stack([game.get_legal_mask() for game in self.games])
+                actions = self.agent.step_batch(states, legal_masks)
+                for game, action in zip(self.games, actions):
+                    state, next_state, reward, done = game.step(action)
                     ts = [state, action, reward, next_state, done]
                     self.agent.feed(ts)
                     if done:
                         self.game.episodes -= 1
-                    self.time = time.time()
+                self.time = time.time()
             else:
                 self.running = False
             
     
     def render(self):
-        # 填充背景色
-        self.window.fill(self.BGCOLOR)
-        
-        # 显示分隔线
-        for i in range(self.ROW + 1):
-            LINECOLOR = (72,61,139)
-            pygame.draw.line(self.window, LINECOLOR, (0, i*self.SIZE), (self.COL*self.SIZE, i*self.SIZE), 4)
-        for i in range(self.COL + 1):
-            pygame.draw.line(self.window, LINECOLOR, (i*self.SIZE, 0), (i*self.SIZE, self.ROW*self.SIZE), 4)
-        
-        # 显示巧克力
-        for i in range(self.ROW):
-            for j in range(self.COL):
-                if self.game.state['obs'][i, j] == 1:
-                    self.window.blit(self.img, (j*self.SIZE, i*self.SIZE))
-        
-        # 显示选中提示
-        if self.select['pos'] is not None:
-            (x, y) = self.select['pos']
-            self.window.blit(self.select_text, (y*self.SIZE , (x+0.4)*self.SIZE))
-            # 显示选中格子的合法动作
-            for one in self.select['legal_pos']:
-                x, y = one
-                self.window.blit(self.img_legal, ((y+0.2)*self.SIZE, (x+0.2)*self.SIZE))
-            
-        
-        # pygame刷新显示
-        pygame.display.update()
+        obs = self.game.state['obs']
+        overlay = self.select['pos'] is not None
+
+        if self.prev_obs is None or overlay or self.overlay_shown:
+            # 全屏重绘: 第一帧, 或选中提示出现/需要清除
+            self.window.blit(self.bg, (0, 0))
+
+            # 显示巧克力
+            ys, xs = np.where(obs == 1)
+            self.window.blits([(self.img, self.cell_px[i, j]) for i, j in zip(ys, xs)])
+
+            # 显示选中提示
+            if overlay:
+                (x, y) = self.select['pos']
+                self.window.blit(self.select_text, (y*self.SIZE , (x+0.4)*self.SIZE))
+                # 显示选中格子的合法动作
+                for one in self.select['legal_pos']:
+                    x, y = one
+                    self.window.blit(self.img_legal, self.hint_px[x, y])
+
+            # pygame刷新显示
+            pygame.display.update()
+
+        else:
+            # 只重绘有变化的格子 (dirty rects)
+            rects = []
+            for i, j in zip(*np.where(self.prev_obs != obs)):
+                rect = pygame.Rect(self.cell_px[i, j][0], self.cell_px[i, j][1],
+                                   self.SIZE, self.SIZE)
+                self.window.blit(self.bg, rect.topleft, rect)
+                if obs[i, j] == 1:
+                    self.window.blit(self.img, rect.topleft)
+                rects.append(rect)
+            if rects:
+                pygame.display.update(rects)
+
+        self.prev_obs = obs.copy()
+        self.overlay_shown = overlay
         
     # 主循环
     def run(self):
         while self.running:
             self.processInput()
             self.update()
-            self.render()
+            if self.AI_mode and not self.human_mode:
+                # Bulk training: skip the whole draw pipeline and the FPS
+                # cap, events are still pumped by processInput above
+                continue
+            if self.dirty:
+                self.render()
+                self.dirty = False
             self.clock.tick(self.FPS)
         
 
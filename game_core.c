@@ -0,0 +1,83 @@
+/*
+ * Optional C accelerator for the Ferrero game bitboard.
+ * Build in place with:  python setup.py build_ext --inplace
+ * game.py falls back to the numba/Python kernels when the module is absent.
+ *
+ * The board is a 48-bit word with bit i*COL+j for cell (i, j), the same
+ * layout as legal_actions_nb in game.py.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+static PyObject *
+legal_actions(PyObject *self, PyObject *args)
+{
+    unsigned long long bits, full, col_ge2, col_le2;
+    int row, col;
+    if (!PyArg_ParseTuple(args, "KiiKKK", &bits, &row, &col,
+                          &full, &col_ge2, &col_le2))
+        return NULL;
+
+    unsigned long long empty = ~bits & full;
+    unsigned long long up    = bits & (bits << col) & (empty << (2*col));
+    unsigned long long down  = bits & (bits >> col) & (empty >> (2*col));
+    unsigned long long left  = bits & (bits << 1) & (empty << 2) & col_ge2;
+    unsigned long long right = bits & (bits >> 1) & (empty >> 2) & col_le2;
+
+    int actions[256];
+    int n = 0;
+    int cells = row * col;
+    for (int idx = 0; idx < cells; idx++) {
+        unsigned long long b = 1ULL << idx;
+        if (up & b)    actions[n++] = idx*4 + 0;
+        if (down & b)  actions[n++] = idx*4 + 1;
+        if (left & b)  actions[n++] = idx*4 + 2;
+        if (right & b) actions[n++] = idx*4 + 3;
+    }
+
+    PyObject *list = PyList_New(n);
+    if (list == NULL)
+        return NULL;
+    for (int i = 0; i < n; i++)
+        PyList_SET_ITEM(list, i, PyLong_FromLong(actions[i]));
+    return list;
+}
+
+static PyObject *
+is_end(PyObject *self, PyObject *args)
+{
+    unsigned long long bits, full, col_ge2, col_le2;
+    int row, col;
+    if (!PyArg_ParseTuple(args, "KiiKKK", &bits, &row, &col,
+                          &full, &col_ge2, &col_le2))
+        return NULL;
+
+    unsigned long long empty = ~bits & full;
+    unsigned long long up    = bits & (bits << col) & (empty << (2*col));
+    unsigned long long down  = bits & (bits >> col) & (empty >> (2*col));
+    unsigned long long left  = bits & (bits << 1) & (empty << 2) & col_ge2;
+    unsigned long long right = bits & (bits >> 1) & (empty >> 2) & col_le2;
+
+    if (up | down | left | right)
+        Py_RETURN_FALSE;
+    Py_RETURN_TRUE;
+}
+
+static PyMethodDef GameCoreMethods[] = {
+    {"legal_actions", legal_actions, METH_VARARGS,
+     "legal_actions(bits, row, col, full, col_ge2, col_le2) -> list of std_actions"},
+    {"is_end", is_end, METH_VARARGS,
+     "is_end(bits, row, col, full, col_ge2, col_le2) -> bool"},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef game_core_module = {
+    PyModuleDef_HEAD_INIT, "game_core",
+    "C kernels for Ferrero game legal-move generation.", -1, GameCoreMethods
+};
+
+PyMODINIT_FUNC
+PyInit_game_core(void)
+{
+    return PyModule_Create(&game_core_module);
+}
@@ -0,0 +1,8 @@
+# Build the optional game_core C accelerator:
+#     python setup.py build_ext --inplace
+from setuptools import setup, Extension
+
+setup(
+    name='game_core',
+    ext_modules=[Extension('game_core', ['game_core.c'], extra_compile_args=['-O3'])],
+)